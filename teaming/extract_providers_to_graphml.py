@@ -19,12 +19,21 @@ except ImportError:
 
 import networkx as nx
 import pprint
+from collections import Counter
+
+try:
+    import pandas
+except ImportError: # pandas is optional and only needed for the columnar CSV-only fast path
+    pandas = None
 import sys
 import csv
 import json
 import os
+import queue
+import threading
+import logging
+from xml.sax.saxutils import XMLGenerator
 from manipulate_provider_graphml import export_nodes_to_csv
-from manipulate_provider_graphml import export_edges_to_csv
 
 
 def load_configuration(file_name="config.json.example"):
@@ -56,9 +65,13 @@ else:
     CONNECTION_STRING = "x"
 
 
-def logger(string_to_write=""):
-    """Print to the standard input"""
-    print(string_to_write)
+# The edge labels are interned so the millions of edge attribute dictionaries all share a single
+# string object per label instead of one fresh string per row from the database driver
+EDGE_TYPE_LABELS = tuple(sys.intern(label) for label in
+                         ("core-to-core", "leaf-to-core", "core-to-leaf", "leaf-to-leaf", "None"))
+EDGE_TYPE_INTERN = {label: label for label in EDGE_TYPE_LABELS}
+
+log = logging.getLogger(__name__)
 
 
 def get_new_cursor(connection_string="teaming", connection_type="pyodbc"):
@@ -66,7 +79,7 @@ def get_new_cursor(connection_string="teaming", connection_type="pyodbc"):
 
     if connection_type == "pyodbc":
         dsn_name = connection_string
-        logger("Opening connection %s" % dsn_name)
+        log.info("Opening connection %s", dsn_name)
         connection = odbc.connect("DSN=%s" % dsn_name, autocommit=True)
         return connection.cursor()
     elif connection_type == "sqlalchemy":
@@ -75,222 +88,612 @@ def get_new_cursor(connection_string="teaming", connection_type="pyodbc"):
         return connection      
 
 
-def row_to_dictionary(row_obj, exclude_None=True):
+def get_column_names(cursor):
+    """Get the column names of a result set once so they can be reused for every row"""
+    if "description" in dir(cursor) and cursor.description is not None:
+        return [desc[0] for desc in cursor.description]
+    else: # A SQLAlchemy result proxy
+        return list(cursor.keys())
+
+
+def row_to_dictionary(row_obj, column_names, exclude_None=True):
     """Convert a row to a Python dictionary that is easier to work with"""
-    if "cursor_description" in dir(row_obj):
-        column_names = [desc[0] for desc in row_obj.cursor_description]
-        row_dict = {}
-        for i in range(len(column_names)):
-            if exclude_None:
-                if row_obj[i] is not None:
-                    row_dict[column_names[i]] = row_obj[i]
-        return row_dict
-    else:
-        row_dict = dict(row_obj)
-        new_row_dict = {}
-        if exclude_None:
-            for key in row_dict:
-                if row_dict[key] is not None:
-                     new_row_dict[key] = row_dict[key]
-            return new_row_dict
-        else:
-            return dict(row_obj)
+    return {name: value for name, value in zip(column_names, row_obj)
+            if value is not None or not exclude_None}
 
 
-def add_nodes_to_graph(cursor, graph, node_type, label_name = None):
-    """Add nodes to the graph from the return query"""
-    i = 0
-    nodes_initial = len(graph.nodes())
-    for node in cursor:
-        attributes = row_to_dictionary(node)
-        if label_name:
-            if label_name in attributes:
-                attributes["Label"] = attributes[label_name]
-        attributes["node_type"] = node_type
-        graph.add_node(node.npi, attributes)
-        i += 1
-    logger("Read %s rows from table" % i)
-    nodes_final = len(graph.nodes())
-    logger("Imported %s nodes" % (nodes_final - nodes_initial,))
-    return graph
+def chunk_list(values, chunk_size=1000):
+    """Yield successive chunks of a list so it can be sent as IN (...) parameter batches"""
+    for start in range(0, len(values), chunk_size):
+        yield values[start:start + chunk_size]
+
+
+def edge_type_case_expression(to_alias, from_alias):
+    """Build a SQL CASE expression that classifies an edge by the node types on each side"""
+    return """case when %(to)s.node_type = 'C' and %(from)s.node_type = 'C' then '%(cc)s'
+       when %(to)s.node_type = 'C' and %(from)s.node_type = 'L' then '%(lc)s'
+       when %(to)s.node_type = 'L' and %(from)s.node_type = 'C' then '%(cl)s'
+       when %(to)s.node_type = 'L' and %(from)s.node_type = 'L' then '%(ll)s'
+       else '%(na)s' end""" % {"to": to_alias, "from": from_alias,
+                               "cc": EDGE_TYPE_LABELS[0], "lc": EDGE_TYPE_LABELS[1],
+                               "cl": EDGE_TYPE_LABELS[2], "ll": EDGE_TYPE_LABELS[3],
+                               "na": EDGE_TYPE_LABELS[4]}
 
 
-def add_edges_to_graph(cursor, graph, name="shares patients"):
-    """Add edges to the graph from the query"""
+def add_nodes_to_store(cursor, node_store, node_type, label_name = None, arraysize=1024):
+    """Add nodes from the return query to a plain dictionary keyed by NPI"""
     i = 0
-    counter_dict = {}
-
-    for edge in cursor:
-        if edge.to_node_type == 'C' and edge.from_node_type == 'C':
-            edge_type = 'core-to-core'
-        elif edge.from_node_type == 'L' and edge.to_node_type == 'C':
-            edge_type = 'leaf-to-core'
-        elif edge.from_node_type == 'C' and edge.to_node_type == 'L':
-            edge_type = 'core-to-leaf'
-        elif edge.to_node_type == 'L' and edge.from_node_type == 'L':
-            edge_type = 'leaf-to-leaf'
+    nodes_initial = len(node_store)
+    column_names = get_column_names(cursor)
+    npi_index = column_names.index("npi") # Positional access avoids the per-row attribute lookup of the driver
+    while True:
+        rows = cursor.fetchmany(arraysize)
+        if not rows:
+            break
+        for node in rows:
+            attributes = row_to_dictionary(node, column_names)
+            if label_name:
+                if label_name in attributes:
+                    attributes["Label"] = attributes[label_name]
+            attributes["node_type"] = node_type
+            node_store[node[npi_index]] = attributes
+        i += len(rows)
+    log.info("Read %s rows from table", i)
+    nodes_final = len(node_store)
+    log.info("Imported %s nodes", nodes_final - nodes_initial)
+    return node_store
+
+
+def cursor_batches(cursor, arraysize=1024):
+    """Yield fetchmany batches from a cursor until the result set is drained"""
+    while True:
+        rows = cursor.fetchmany(arraysize)
+        if not rows:
+            break
+        yield rows
+
+
+def fetch_query_batches(connection_string, query, batch_queue, arraysize=1024):
+    """Run a query on a dedicated connection and push its row batches onto a queue"""
+    try:
+        fetch_cursor = get_new_cursor(connection_string, engine)
+        fetch_cursor.arraysize = arraysize
+        fetch_cursor.execute(query)
+        for rows in cursor_batches(fetch_cursor, arraysize):
+            batch_queue.put(rows)
+        batch_queue.put(None) # Sentinel so the consumer knows this query is drained
+    except Exception as fetch_error:
+        # Hand the failure to the consumer; swallowing it here would make a failed
+        # query indistinguishable from an empty result and silently truncate the export
+        batch_queue.put(fetch_error)
+
+
+def parallel_query_batches(queries, arraysize=1024):
+    """Run independent queries each on its own connection and yield row batches as they arrive"""
+    batch_queue = queue.Queue(maxsize=8) # Bound the queue so fast readers cannot outrun the consumer
+    fetch_threads = []
+    for query in queries:
+        fetch_thread = threading.Thread(target=fetch_query_batches,
+                                        args=(CONNECTION_STRING, query, batch_queue, arraysize))
+        # Daemon threads so a reader blocked on a full queue cannot hang the process
+        # after the consumer dies mid-iteration
+        fetch_thread.daemon = True
+        fetch_thread.start()
+        fetch_threads.append(fetch_thread)
+
+    queries_finished = 0
+    while queries_finished < len(fetch_threads):
+        rows = batch_queue.get()
+        if rows is None:
+            queries_finished += 1
+        elif isinstance(rows, Exception):
+            raise rows
         else:
-            edge_type = "None"
+            yield rows
+
+    for fetch_thread in fetch_threads:
+        fetch_thread.join()
+
+
+def add_edges_to_store(cursor, edge_store, name="shares patients", arraysize=1024, csv_writer=None):
+    """Add edges to the edge list from the query"""
+    return add_edge_batches_to_store(cursor_batches(cursor, arraysize), edge_store, name=name, csv_writer=csv_writer)
 
-        if edge_type in counter_dict:
+
+def add_edge_batches_to_store(batches, edge_store, name="shares patients", csv_writer=None):
+    """Add edges from an iterable of row batches to a list of (from, to, attributes) triples"""
+    i = 0
+    counter_dict = Counter()
+
+    for edges in batches:
+        for edge in edges:
+            edge_type = EDGE_TYPE_INTERN.get(edge[3], edge[3])
             counter_dict[edge_type] += 1
-        else:
-            counter_dict[edge_type] = 0
 
-        graph.add_edge(edge[0], edge[1], weight=edge[2], edge_type=edge_type)
-        i += 1
+            edge_store.append((edge[0], edge[1], {"weight": edge[2], "edge_type": edge_type}))
+            if csv_writer is not None: # Write the edge CSV while streaming so the graph is not walked a second time
+                csv_writer.writerow((edge[0], edge[1], edge[2], edge_type))
+        i += len(edges)
+
+    log.info("Imported %s edges", i)
+    if log.isEnabledFor(logging.DEBUG): # pformat on a large counter is expensive, skip it unless it will be shown
+        log.debug("Edge types imported")
+        log.debug(pprint.pformat(counter_dict))
+    return edge_store
+
+
+GRAPHML_NAMESPACE = "http://graphml.graphdrawing.org/xmlns"
+
+
+def start_graphml_stream(graphml_file, node_keys, directed=True):
+    """Write the GraphML header and key declarations and return the XML generator"""
+    xml_gen = XMLGenerator(graphml_file, encoding="utf-8", short_empty_elements=True)
+    xml_gen.startDocument()
+    xml_gen.startElement("graphml", {"xmlns": GRAPHML_NAMESPACE})
+    for key_name in node_keys:
+        xml_gen.startElement("key", {"id": key_name, "for": "node",
+                                     "attr.name": key_name, "attr.type": "string"})
+        xml_gen.endElement("key")
+    xml_gen.startElement("key", {"id": "weight", "for": "edge",
+                                 "attr.name": "weight", "attr.type": "long"})
+    xml_gen.endElement("key")
+    xml_gen.startElement("key", {"id": "edge_type", "for": "edge",
+                                 "attr.name": "edge_type", "attr.type": "string"})
+    xml_gen.endElement("key")
+    xml_gen.startElement("graph", {"edgedefault": "directed" if directed else "undirected"})
+    return xml_gen
+
+
+def stream_nodes_to_graphml(xml_gen, cursor, node_type, label_name=None, arraysize=1024, node_ids=None):
+    """Write nodes from the query straight into the GraphML stream"""
+    i = 0
+    column_names = get_column_names(cursor)
+    npi_index = column_names.index("npi")
+    while True:
+        rows = cursor.fetchmany(arraysize)
+        if not rows:
+            break
+        for node in rows:
+            attributes = row_to_dictionary(node, column_names)
+            if label_name:
+                if label_name in attributes:
+                    attributes["Label"] = attributes[label_name]
+            attributes["node_type"] = node_type
+            npi = node[npi_index]
+            if node_ids is not None:
+                node_ids.add(npi)
+            xml_gen.startElement("node", {"id": str(npi)})
+            for attribute_name in attributes:
+                xml_gen.startElement("data", {"key": attribute_name})
+                xml_gen.characters(str(attributes[attribute_name]))
+                xml_gen.endElement("data")
+            xml_gen.endElement("node")
+        i += len(rows)
+    log.info("Read %s rows from table", i)
+    log.info("Wrote %s nodes", i)
+
+
+def stream_edge_batches_to_graphml(xml_gen, batches, endpoint_ids=None):
+    """Write edges from an iterable of row batches straight into the GraphML stream"""
+    i = 0
+    counter_dict = Counter()
+    for edges in batches:
+        for edge in edges:
+            edge_type = EDGE_TYPE_INTERN.get(edge[3], edge[3])
+            counter_dict[edge_type] += 1
+            if endpoint_ids is not None: # Collected so undeclared endpoints can get bare node elements
+                endpoint_ids.add(edge[0])
+                endpoint_ids.add(edge[1])
+            xml_gen.startElement("edge", {"source": str(edge[0]), "target": str(edge[1])})
+            xml_gen.startElement("data", {"key": "weight"})
+            xml_gen.characters(str(edge[2]))
+            xml_gen.endElement("data")
+            xml_gen.startElement("data", {"key": "edge_type"})
+            xml_gen.characters(edge_type)
+            xml_gen.endElement("data")
+            xml_gen.endElement("edge")
+        i += len(edges)
+
+    log.info("Wrote %s edges", i)
+    if log.isEnabledFor(logging.DEBUG): # pformat on a large counter is expensive, skip it unless it will be shown
+        log.debug("Edge types written")
+        log.debug(pprint.pformat(counter_dict))
+
+
+def end_graphml_stream(xml_gen):
+    """Close the graph and graphml elements of a streamed GraphML document"""
+    xml_gen.endElement("graph")
+    xml_gen.endElement("graphml")
+    xml_gen.endDocument()
+
+
+def _fast_build(node_store, edge_store, graph_type="directed"):
+    """Assemble a NetworkX graph by building its internal dictionaries directly.
+
+    This skips the per-call bookkeeping of the add_node/add_edge APIs and is only
+    safe because the graph is subsequently just serialised, never mutated.
+    """
+    _node = node_store
+    _succ = {npi: {} for npi in _node}
+    _pred = {npi: {} for npi in _node}
+    for from_npi, to_npi, attributes in edge_store:
+        if from_npi not in _node:
+            _node[from_npi] = {}
+            _succ[from_npi] = {}
+            _pred[from_npi] = {}
+        if to_npi not in _node:
+            _node[to_npi] = {}
+            _succ[to_npi] = {}
+            _pred[to_npi] = {}
+        _succ[from_npi][to_npi] = attributes
+        _pred[to_npi][from_npi] = attributes
+        if graph_type != "directed": # An undirected adjacency holds the edge under both endpoints
+            _succ[to_npi][from_npi] = attributes
 
-    logger("Imported %s edges" % i)
-    logger("Edge types imported")
-    logger(pprint.pformat(counter_dict))
+    if graph_type == "directed":
+        graph = nx.DiGraph()
+        graph._node = _node
+        graph._adj = graph._succ = _succ
+        graph._pred = _pred
+    else:
+        graph = nx.Graph()
+        graph._node = _node
+        graph._adj = _succ
     return graph
 
 
+def add_nodes_to_rows(cursor, node_rows, node_type, label_name=None, arraysize=1024):
+    """Accumulate node attribute dictionaries from the query for a columnar CSV export"""
+    i = 0
+    column_names = get_column_names(cursor)
+    npi_index = column_names.index("npi")
+    while True:
+        rows = cursor.fetchmany(arraysize)
+        if not rows:
+            break
+        for node in rows:
+            attributes = row_to_dictionary(node, column_names)
+            if label_name:
+                if label_name in attributes:
+                    attributes["Label"] = attributes[label_name]
+            attributes["node_type"] = node_type
+            attributes["node_id"] = node[npi_index]
+            node_rows.append(attributes)
+        i += len(rows)
+    log.info("Read %s rows from table", i)
+    return node_rows
+
+
+def add_edges_to_columns(cursor, edge_columns, arraysize=1024):
+    """Accumulate edge rows from the query into columnar lists for a DataFrame export"""
+    return add_edge_batches_to_columns(cursor_batches(cursor, arraysize), edge_columns)
+
+
+def add_edge_batches_to_columns(batches, edge_columns):
+    """Accumulate edge row batches into columnar lists for a DataFrame export"""
+    i = 0
+    counter_dict = Counter()
+    npi_from_column = edge_columns["npi_from"]
+    npi_to_column = edge_columns["npi_to"]
+    weight_column = edge_columns["weight"]
+    edge_type_column = edge_columns["edge_type"]
+
+    for edges in batches:
+        for edge in edges:
+            edge_type = EDGE_TYPE_INTERN.get(edge[3], edge[3])
+            npi_from_column.append(edge[0])
+            npi_to_column.append(edge[1])
+            weight_column.append(edge[2])
+            edge_type_column.append(edge_type)
+            counter_dict[edge_type] += 1
+        i += len(edges)
+
+    log.info("Imported %s edges", i)
+    if log.isEnabledFor(logging.DEBUG): # pformat on a large counter is expensive, skip it unless it will be shown
+        log.debug("Edge types imported")
+        log.debug(pprint.pformat(counter_dict))
+    return edge_columns
+
+
 def extract_provider_network(where_criteria, referral_table_name=REFERRAL_TABLE_NAME, npi_detail_table_name=NPI_DETAIL_TABLE_NAME,
          field_name_to_relationship=FIELD_NAME_TO_RELATIONSHIP, field_name_from_relationship=FIELD_NAME_FROM_RELATIONSHIP,
          file_name_prefix="",add_leaf_to_leaf_edges=False, node_label_name="provider_name",
-         field_name_weight=FIELD_NAME_WEIGHT, add_leaf_nodes=True, graph_type="directed", csv_output=True, directory="./"):
+         field_name_weight=FIELD_NAME_WEIGHT, add_leaf_nodes=True, graph_type="directed", csv_output=True, directory="./",
+         arraysize=1024, graphml_output=True, where_parameters=(), stream_graphml=False):
     """Main script for extracting the provider graph from the MySQL database."""
 
     cursor = get_new_cursor(CONNECTION_STRING, engine) #Get an active connection to the database
+    if engine == "pyodbc":
+        cursor.arraysize = arraysize # Rows fetched per ODBC round-trip; tune down for very wide result sets
 
     #Show the configuration that the script is running with
     #To pipe the output to a file use the > operator to redirect output to a file:
     #python extract_providers_to_graphml.py "zip5 in ('02535,'02539','02568','02557','02575')" mi_prov Leaf-edges > log.txt
 
-    logger("Configuration")
-    logger("Selection criteria for subset graph: %s" % where_criteria)
-    logger("Referral table _name: %s" % referral_table_name)
-    logger("NPI detail table name: %s" % npi_detail_table_name)
-    logger("Nodes will be labelled by: %s" % node_label_name)
-    logger("Leaf-to-leaf edges will be exported? %s" % add_leaf_to_leaf_edges)
+    log.info("Configuration")
+    log.info("Selection criteria for subset graph: %s", where_criteria)
+    log.info("Referral table _name: %s", referral_table_name)
+    log.info("NPI detail table name: %s", npi_detail_table_name)
+    log.info("Nodes will be labelled by: %s", node_label_name)
+    log.info("Leaf-to-leaf edges will be exported? %s", add_leaf_to_leaf_edges)
 
-    logger()
     drop_table_sql = "drop table if exists npi_to_export_to_graph;" # This table is a temporary table but it is not designed for concurrent running of the script
-    logger(drop_table_sql)
+    log.debug(drop_table_sql)
     cursor.execute(drop_table_sql) # Drop table that was used in the last export of a provider graph
 
-    logger()
     create_table_sql = "create table npi_to_export_to_graph (npi char(10),node_type char(1));" # Create the temporary table for storing NPI extracted from the graph
     # Type of a node can be either core or leaf. The core node is one that is directly selected based on the selection criteria. The selection
     # criteria is specified as a SQL where clause on the commandline. The leaf nodes are nodes that are connected through a shared edge with the core.
 
-    logger(create_table_sql)
+    log.debug(create_table_sql)
     cursor.execute(create_table_sql)
 
     # Get NPI from each side of the relationship
     # The teaming database is a directed graph. Between two nodes (providers) they can have different connection directions.
 
-    query_first_part = """select distinct npi from %s rt1 join %s tnd1 on rt1.%s = tnd1.npi where %s""" % (referral_table_name,npi_detail_table_name,field_name_from_relationship, where_criteria)
-    query_second_part = """select distinct npi from %s rt2 join %s tnd2 on rt2.%s = tnd2.npi where %s""" % (referral_table_name,npi_detail_table_name,field_name_to_relationship, where_criteria)
-    core_node_query_to_execute = "insert into npi_to_export_to_graph (npi,node_type) select t.*,'C' from (\n%s\nunion\n%s)\nt;" % (query_first_part, query_second_part)
-    
+    # A single query returns the full core node detail directly instead of inserting the core NPIs
+    # into the temp table and scanning the detail table a second time to join them back
+    core_node_query_to_execute = """select tnd.* from %s tnd where (%s)
+ and exists (select 1 from %s rt where tnd.npi in (rt.%s, rt.%s))""" % (npi_detail_table_name, where_criteria, referral_table_name, field_name_from_relationship, field_name_to_relationship)
+
     if engine == "sqlalchemy":
         if "%" in core_node_query_to_execute:
             core_node_query_to_execute = "%%".join(core_node_query_to_execute.split("%"))
-    logger(core_node_query_to_execute)
-    cursor.execute(core_node_query_to_execute)
-
-    # Add an index to the temporary table to make extraction of node detail to happen in a reasonable amount of time
-    logger("Adding indices")
-    cursor.execute("create unique index idx_primary_npi_graph on npi_to_export_to_graph(npi);")
-    npi_detail_query_to_execute = "select * from npi_to_export_to_graph neg join %s tnd on tnd.npi = neg.npi" % npi_detail_table_name
-    logger(npi_detail_query_to_execute)
+    log.debug(core_node_query_to_execute)
+
+    # When only the CSV files are needed the NetworkX dict-of-dicts graph is a costly intermediate;
+    # the rows are instead collected into columnar lists that pandas writes out at C speed
+    columnar_export = csv_output and not graphml_output and pandas is not None
+    if not graphml_output and pandas is None:
+        log.warning("pandas is not installed so the columnar CSV fast path is not available")
+
+    if stream_graphml:
+        # The GraphML document is templated straight from the cursor rows, so nothing is held in
+        # memory in proportion to the edge count; only the GraphML file is produced in this mode
+        csv_output = False
+        columnar_export = False
+        # XMLGenerator ignores its encoding argument on a text stream, so the file itself has
+        # to be opened as UTF-8 to match the declaration in the XML prolog
+        graphml_stream_file = open(os.path.join(directory, file_name_prefix + ".graphml"), "w",
+                                   encoding="utf-8", buffering=1024 * 1024)
+    elif columnar_export:
+        node_rows = []
+        edge_columns = {"npi_from": [], "npi_to": [], "weight": [], "edge_type": []}
+    else:
+        # The nodes and edges are collected into plain containers and the graph is assembled
+        # by _fast_build right before serialisation
+        node_store = {}
+        edge_store = []
 
     # Populate the nodes are directly selected criteria
-    logger("Populating core nodes")
-    cursor_result = cursor.execute(npi_detail_query_to_execute)
-
-    # Select the default directed graph. Here we call the networkx Graph object
-    if graph_type == "directed":
-        ProviderGraph = nx.DiGraph()
-    elif graph_type == "undirected": # Warning this is not tested currently
-        ProviderGraph = nx.Graph()
-
-    ProviderGraph = add_nodes_to_graph(cursor_result, ProviderGraph, "core", label_name=node_label_name)
+    log.info("Populating core nodes")
+    # The where clause values travel as query parameters; the SQL text stays stable across runs
+    # so the server can reuse its plan and quoting issues in the criteria values cannot break the query
+    if where_parameters:
+        cursor_result = cursor.execute(core_node_query_to_execute, list(where_parameters))
+    else:
+        cursor_result = cursor.execute(core_node_query_to_execute)
+
+    if stream_graphml:
+        node_key_names = get_column_names(cursor_result)
+        node_key_names += [key for key in ("Label", "node_type") if key not in node_key_names]
+        xml_gen = start_graphml_stream(graphml_stream_file, node_key_names,
+                                       directed=(graph_type == "directed"))
+        core_npis = set()
+        stream_nodes_to_graphml(xml_gen, cursor_result, "core", label_name=node_label_name,
+                                arraysize=arraysize, node_ids=core_npis)
+        streamed_npis = set(core_npis) # Every node id declared in the document so far
+        edge_endpoint_npis = set()
+    elif columnar_export:
+        node_rows = add_nodes_to_rows(cursor_result, node_rows, "core", label_name=node_label_name, arraysize=arraysize)
+        core_npis = {node_row["node_id"] for node_row in node_rows}
+    else:
+        node_store = add_nodes_to_store(cursor_result, node_store, "core", label_name=node_label_name, arraysize=arraysize)
+        core_npis = set(node_store) # Only core nodes have been imported at this point
+    log.info("Selected %s core NPIs", len(core_npis))
+
+    if engine == "pyodbc":
+        leaf_npis = set()
+        if add_leaf_nodes:
+            log.info("Finding leaf nodes connected to the core nodes")
+            for npi_chunk in chunk_list(list(core_npis)):
+                placeholders = ",".join(["?"] * len(npi_chunk))
+                neighbor_query_to_execute = "select rt.%s, rt.%s from %s rt where rt.%s in (%s) or rt.%s in (%s)" % (
+                    field_name_from_relationship, field_name_to_relationship, referral_table_name,
+                    field_name_from_relationship, placeholders, field_name_to_relationship, placeholders)
+                cursor.execute(neighbor_query_to_execute, npi_chunk + npi_chunk)
+                for row in cursor.fetchall():
+                    leaf_npis.add(row[0])
+                    leaf_npis.add(row[1])
+            leaf_npis -= core_npis # A set difference replaces the old server-side anti-join
+            log.info("Selected %s leaf NPIs", len(leaf_npis))
+
+        # The temp table is still needed for the leaf detail and edge joins; it is populated in one executemany round
+        npi_rows_to_insert = [(npi, 'C') for npi in core_npis] + [(npi, 'L') for npi in leaf_npis]
+        if npi_rows_to_insert: # executemany raises on an empty parameter list
+            insert_npi_sql = "insert into npi_to_export_to_graph (npi,node_type) values (?,?)"
+            log.debug(insert_npi_sql)
+            if hasattr(cursor, "fast_executemany"): # One bulk round-trip instead of one insert per NPI
+                cursor.fast_executemany = True
+            cursor.executemany(insert_npi_sql, npi_rows_to_insert)
+    else:
+        # The SQLAlchemy fallback connection has no ? paramstyle, fetchall or executemany, so the
+        # temp table is populated with the original server-side inserts instead
+        insert_core_npi_sql = """insert into npi_to_export_to_graph (npi,node_type)
+ select distinct tnd.npi,'C' from %s rt join %s tnd on tnd.npi in (rt.%s, rt.%s) where %s""" % (
+            referral_table_name, npi_detail_table_name, field_name_from_relationship,
+            field_name_to_relationship, where_criteria)
+        if "%" in insert_core_npi_sql:
+            insert_core_npi_sql = "%%".join(insert_core_npi_sql.split("%"))
+        log.debug(insert_core_npi_sql)
+        cursor.execute(insert_core_npi_sql)
+
+        if add_leaf_nodes:
+            log.info("Finding leaf nodes connected to the core nodes")
+            insert_leaf_npi_sql = """insert into npi_to_export_to_graph (npi,node_type)
+ select t.npi,'L' from (
+  select distinct rt1.%s as npi from npi_to_export_to_graph neg1 join %s rt1 on rt1.%s = neg1.npi
+   union
+  select distinct rt2.%s as npi from npi_to_export_to_graph neg2 join %s rt2 on rt2.%s = neg2.npi
+ ) t left join npi_to_export_to_graph negx on negx.npi = t.npi where negx.npi is null""" % (
+                field_name_to_relationship, referral_table_name, field_name_from_relationship,
+                field_name_from_relationship, referral_table_name, field_name_to_relationship)
+            log.debug(insert_leaf_npi_sql)
+            cursor.execute(insert_leaf_npi_sql)
+
+    # Add an index to the temporary table to make the edge and leaf detail joins happen in a reasonable amount of time
+    log.info("Adding indices")
+    cursor.execute("create unique index idx_primary_npi_graph on npi_to_export_to_graph(npi);")
 
     # If leaf nodes are select the script will import them into the database
     if add_leaf_nodes:
-        logger("Adding leaf nodes")
-
-        add_leaf_node_query_to_execute = """insert into npi_to_export_to_graph (npi,node_type)
-        select t.npi,'L'  from (
-      select distinct rt1.%s as npi FROM npi_to_export_to_graph neg1 join %s rt1 on rt1.%s = neg1.npi
-        union
-      select distinct rt2.%s as npi FROM npi_to_export_to_graph neg2 join %s rt2 on rt2.%s = neg2.npi
-      ) t where npi not in (select npi from npi_to_export_to_graph)""" % (field_name_from_relationship, referral_table_name, field_name_to_relationship, field_name_to_relationship, referral_table_name, field_name_from_relationship)
-
-        logger(add_leaf_node_query_to_execute)
-        cursor.execute(add_leaf_node_query_to_execute)
-
         # These are the connected nodes to the primary nodes
-        logger("Populating leaf nodes")
+        log.info("Populating leaf nodes")
 
         # Populate the details to the leaf nodes
-        populate_leaf_nodes_query_to_execute = """select * from npi_to_export_to_graph neg join %s tnd
+        populate_leaf_nodes_query_to_execute = """select tnd.* from npi_to_export_to_graph neg join %s tnd
             on tnd.npi = neg.npi where neg.node_type = 'L'""" % npi_detail_table_name
-        logger(populate_leaf_nodes_query_to_execute)
+        log.debug(populate_leaf_nodes_query_to_execute)
         cursor_result = cursor.execute(populate_leaf_nodes_query_to_execute)
-        ProviderGraph = add_nodes_to_graph(cursor_result, ProviderGraph, "leaf", label_name=node_label_name)
+        if stream_graphml:
+            stream_nodes_to_graphml(xml_gen, cursor_result, "leaf", label_name=node_label_name,
+                                    arraysize=arraysize, node_ids=streamed_npis)
+        elif columnar_export:
+            node_rows = add_nodes_to_rows(cursor_result, node_rows, "leaf", label_name=node_label_name, arraysize=arraysize)
+        else:
+            node_store = add_nodes_to_store(cursor_result, node_store, "leaf", label_name=node_label_name, arraysize=arraysize)
 
     # Add in the edges to the data
-    logger("Populating edges")
+    log.info("Populating edges")
 
     query_first_part_edges = """select rt1.%s,rt1.%s, rt1.%s,
-  neg1.node_type as to_node_type, negf.node_type as from_node_type
+  %s as edge_type
    from %s rt1 join npi_to_export_to_graph neg1 on rt1.%s = neg1.npi
        join npi_to_export_to_graph negf on negf.npi = rt1.%s
-  where neg1.node_type = 'C'""" % (field_name_from_relationship, field_name_to_relationship, field_name_weight, referral_table_name, field_name_to_relationship, field_name_from_relationship)
+  where neg1.node_type = 'C'""" % (field_name_from_relationship, field_name_to_relationship, field_name_weight,
+                                   edge_type_case_expression("neg1", "negf"),
+                                   referral_table_name, field_name_to_relationship, field_name_from_relationship)
 
+    # The second query excludes edges whose to side is core so the two halves are disjoint and
+    # can be run independently; the first query already covers every edge pointing at a core node
     query_second_part_edges = """select rt2.%s, rt2.%s, rt2.%s,
-  negt.node_type as to_node_type, neg2.node_type as from_node_type
+  %s as edge_type
    from %s rt2 join npi_to_export_to_graph neg2 on rt2.%s = neg2.npi
        join npi_to_export_to_graph negt on negt.npi = rt2.%s
-  where neg2.node_type = 'C'""" % (field_name_from_relationship, field_name_to_relationship, field_name_weight, referral_table_name, field_name_from_relationship, field_name_to_relationship)
+  where neg2.node_type = 'C' and negt.node_type <> 'C'""" % (field_name_from_relationship, field_name_to_relationship, field_name_weight,
+                                   edge_type_case_expression("negt", "neg2"),
+                                   referral_table_name, field_name_from_relationship, field_name_to_relationship)
 
-    add_core_query_to_execute = "%s\nunion\n%s" % (query_first_part_edges, query_second_part_edges)
+    # Stream the edge CSV while the edges are fetched so the graph does not have to be walked a second time
+    if csv_output and not columnar_export:
+        csv_edge_file_name = os.path.join(directory, file_name_prefix + "_edges.csv")
+        log.info("Writing CSV of edges with weights")
+        csv_edge_file = open(csv_edge_file_name, "w", newline="", buffering=1024 * 1024)
+        csv_edge_writer = csv.writer(csv_edge_file)
+        csv_edge_writer.writerow(["npi_from", "npi_to", "weight", "edge_type"])
+    else:
+        csv_edge_file = None
+        csv_edge_writer = None
 
-    # Add the leaf edges to the data
-    logger(add_core_query_to_execute)
-    cursor_result = cursor.execute(add_core_query_to_execute)
-    ProviderGraph = add_edges_to_graph(cursor_result, ProviderGraph)
+    log.debug(query_first_part_edges)
+    log.debug(query_second_part_edges)
+
+    if engine == "pyodbc":
+        # The two halves scan the referral table independently, so run them on their own
+        # connections in parallel and merge the batches on the client
+        log.info("Running the edge queries on two parallel connections")
+        edge_batches = parallel_query_batches([query_first_part_edges, query_second_part_edges], arraysize=arraysize)
+    else:
+        add_core_query_to_execute = "%s\nunion\n%s" % (query_first_part_edges, query_second_part_edges)
+        cursor_result = cursor.execute(add_core_query_to_execute)
+        edge_batches = cursor_batches(cursor_result, arraysize)
+
+    if stream_graphml:
+        stream_edge_batches_to_graphml(xml_gen, edge_batches, endpoint_ids=edge_endpoint_npis)
+    elif columnar_export:
+        edge_columns = add_edge_batches_to_columns(edge_batches, edge_columns)
+    else:
+        edge_store = add_edge_batches_to_store(edge_batches, edge_store, csv_writer=csv_edge_writer)
 
     if add_leaf_to_leaf_edges: #Danger is that there are too many leaves
-        logger("Add leaf edges")
+        log.info("Add leaf edges")
 
         leaf_query_to_execute = """select rt3.%s, rt3.%s, rt3.%s,
-        negt3.node_type as to_node_type, negf3.node_type as from_node_type
+        %s as edge_type
       from %s rt3 join npi_to_export_to_graph negt3 on rt3.%s = negt3.npi
       join npi_to_export_to_graph negf3 on rt3.%s = negf3.npi
-      join npi_to_export_to_graph negf3 on rt3.%s = negf3.npi
       where negt3.node_type = 'L' and negf3.node_type = 'L'
-      ;""" % (field_name_from_relationship, field_name_to_relationship, field_name_weight, referral_table_name,
+      ;""" % (field_name_from_relationship, field_name_to_relationship, field_name_weight,
+              edge_type_case_expression("negt3", "negf3"), referral_table_name,
               field_name_to_relationship, field_name_from_relationship)
         cursor_result = cursor.execute(leaf_query_to_execute)
-        logger(leaf_query_to_execute)
-        add_edges_to_graph(cursor_result, ProviderGraph)
+        log.debug(leaf_query_to_execute)
+        if stream_graphml:
+            stream_edge_batches_to_graphml(xml_gen, cursor_batches(cursor_result, arraysize),
+                                           endpoint_ids=edge_endpoint_npis)
+        elif columnar_export:
+            edge_columns = add_edges_to_columns(cursor_result, edge_columns, arraysize=arraysize)
+        else:
+            add_edges_to_store(cursor_result, edge_store, arraysize=arraysize, csv_writer=csv_edge_writer)
     else:
-        logger("Leaf-to-leaf edges were not selected for export")
+        log.info("Leaf-to-leaf edges were not selected for export")
+
+    if csv_edge_file is not None:
+        csv_edge_file.close()
+
+    if stream_graphml:
+        # Edge endpoints with no row in the detail table never went through a node query, so
+        # declare them as bare nodes just as _fast_build creates empty nodes for them
+        missing_npis = edge_endpoint_npis - streamed_npis
+        if missing_npis:
+            log.info("Writing %s bare nodes for endpoints missing from the detail table", len(missing_npis))
+            for npi in missing_npis:
+                xml_gen.startElement("node", {"id": str(npi)})
+                xml_gen.endElement("node")
+        end_graphml_stream(xml_gen)
+        graphml_stream_file.close()
+        return
+
+    if columnar_export:
+        log.info("Writing CSV of edges with weights")
+        edge_frame = pandas.DataFrame(edge_columns)
+        edge_frame.to_csv(os.path.join(directory, file_name_prefix + "_edges.csv"), index=False)
+
+        log.info("Writing CSV of nodes with attributes")
+        # Edge endpoints that have no row in the detail table still appear in the edge CSV, so
+        # give them a bare node row just as the graph build path creates bare nodes for them
+        known_npis = {node_row["node_id"] for node_row in node_rows}
+        missing_npis = (set(edge_columns["npi_from"]) | set(edge_columns["npi_to"])) - known_npis
+        if missing_npis:
+            log.info("Adding %s bare nodes for endpoints missing from the detail table", len(missing_npis))
+            node_rows.extend({"node_id": npi} for npi in missing_npis)
+        node_frame = pandas.DataFrame(node_rows)
+        if "node_id" in node_frame.columns: # Keep the node identifier as the leading column
+            node_frame = node_frame[["node_id"] + [column for column in node_frame.columns if column != "node_id"]]
+        node_frame.to_csv(os.path.join(directory, file_name_prefix + "_node_db.csv"), index=False)
+        return
+
+    ProviderGraph = _fast_build(node_store, edge_store, graph_type=graph_type)
 
     print(nx.info(ProviderGraph))
 
 
-    logger("Writing GraphML file")
-    nx.write_graphml(ProviderGraph, os.path.join(directory, file_name_prefix + ".graphml"))
+    if graphml_output:
+        log.info("Writing GraphML file")
+        # generate_graphml yields the document line by line so the full serialisation is never held in memory
+        with open(os.path.join(directory, file_name_prefix + ".graphml"), "w") as graphml_file:
+            for graphml_line in nx.generate_graphml(ProviderGraph):
+                graphml_file.write(graphml_line + "\n")
 
     if csv_output:
-        csv_edge_file_name = os.path.join(directory, file_name_prefix + "_edges.csv")
-
-        logger("Writing CSV of edges with weights")
-        export_edges_to_csv(csv_edge_file_name, ProviderGraph)
-
         csv_node_file_name = os.path.join(directory, file_name_prefix + "_node_db.csv")
-        logger("Writing CSV of nodes with attributes")
+        log.info("Writing CSV of nodes with attributes")
 
         export_nodes_to_csv(csv_node_file_name, ProviderGraph)
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     number_of_args = len(sys.argv)
     if number_of_args == 1:
         print("""Usage:
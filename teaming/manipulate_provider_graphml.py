@@ -10,41 +10,27 @@ import json
 
 def export_edges_to_csv(csv_edge_file_name, provider_graph_to_export):
     """Export edges to CSV"""
-    with open(csv_edge_file_name, "wb") as f:
+    with open(csv_edge_file_name, "w", newline="", buffering=1024 * 1024) as f:
         csv_edges = csv.writer(f)
         csv_edges.writerow(["npi_from", "npi_to", "weight", "edge_type"])
-        for node1 in provider_graph_to_export.edge:
-            for node2 in provider_graph_to_export.edge[node1]:
-                npi_from = node1
-                npi_to = node2
-                edge_data = provider_graph_to_export[node1][node2]
-                csv_edges.writerow((npi_from, npi_to, edge_data["weight"], edge_data["edge_type"]))
+        # edges(data=True) yields (from, to, attributes) directly; walking the adjacency dict by
+        # hand cost three dict lookups per edge and the .edge attribute is gone in NetworkX 2
+        for npi_from, npi_to, edge_data in provider_graph_to_export.edges(data=True):
+            csv_edges.writerow((npi_from, npi_to, edge_data.get("weight"), edge_data.get("edge_type")))
 
 
 def export_nodes_to_csv(csv_node_file_name, provider_graph_to_export):
     """Export nodes to CSV"""
-    with open(csv_node_file_name, "wb") as fw:
+    # The header is the union of the attribute keys across all nodes; deriving it from the
+    # first node only would silently drop attributes that node happens to be missing
+    all_keys = sorted(set().union(*(node_dict.keys() for _, node_dict in provider_graph_to_export.nodes(data=True))))
+    with open(csv_node_file_name, "w", newline="", buffering=1024 * 1024) as fw:
         i = 0
-        csv_nodes = csv.writer(fw)
-        for node in provider_graph_to_export.node:
-
-            node_dict = provider_graph_to_export.node[node]
-            if i == 0:
-                header = node_dict.keys()
-
-                header.sort()
-                header = ["node_id"] + header
-
-                csv_nodes.writerow(header)
-
-            row_to_write = [node]
-            for attribute in header[1:]:
-                if attribute in node_dict:
-                    value_to_write = node_dict[attribute]
-                else:
-                    value_to_write = ''
-
-                row_to_write += [value_to_write]
+        csv_nodes = csv.DictWriter(fw, fieldnames=["node_id"] + all_keys, restval='', extrasaction="ignore")
+        csv_nodes.writeheader()
+        for node, node_dict in provider_graph_to_export.nodes(data=True):
+            row_to_write = {"node_id": node}
+            row_to_write.update(node_dict)
             csv_nodes.writerow(row_to_write)
 
             i += 1
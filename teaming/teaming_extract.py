@@ -12,6 +12,7 @@ __author__ = 'Janos G. Hajagos'
 
 from extract_providers_to_graphml import *
 from optparse import OptionParser
+import logging
 
 
 def string_list_to_python_list(string_list):
@@ -19,9 +20,10 @@ def string_list_to_python_list(string_list):
 
 
 def field_selection_with_like(field_name, like_values, padding_left_side=True, padding_right_side=False,
-                              wild_card_left_side=False, wild_card_right_side=True, padder=""):
+                              wild_card_left_side=False, wild_card_right_side=True, padder="", parameterized=False):
 
     sql_string = ""
+    parameters = []
 
     for like_value in like_values:
         like_value_string = ""
@@ -37,10 +39,16 @@ def field_selection_with_like(field_name, like_values, padding_left_side=True, p
         if wild_card_right_side:
             like_value_string += '%'
 
-        sql_string += "%s like '%s'" % (field_name, like_value_string)
+        if parameterized: # Send the values as query parameters so the SQL text stays stable and injection safe
+            sql_string += "%s like ?" % field_name
+            parameters.append(like_value_string)
+        else:
+            sql_string += "%s like '%s'" % (field_name, like_value_string)
         sql_string += " or "
 
     sql_string = sql_string[:-4]
+    if parameterized:
+        return "(" + sql_string + ")", parameters
     return "(" + sql_string + ")"
 
 
@@ -54,6 +62,7 @@ def field_selection_with_equal(field_names, equal_value=1):
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
 
     parser = OptionParser()
     parser.add_option("-z", "--zip_codes", dest="zip_codes", default=None,
@@ -79,45 +88,64 @@ if __name__ == "__main__":
 
     parser.add_option("-i", "--institutional_provider", dest="blank_sole_provider", help="Extract providers that are institutional based.", action="store_true", default=False)
 
+    parser.add_option("-o", "--csv_only", dest="csv_only", help="Only write the node and edge CSV files and skip the GraphML file. Skipping the GraphML file avoids building the in-memory graph and uses much less RAM on large extracts.", action="store_true", default=False)
+
+    parser.add_option("-m", "--stream_graphml", dest="stream_graphml", help="Stream the GraphML file directly from the database rows and skip the in-memory graph and the CSV files. Use this for graphs that are too large to hold in RAM.", action="store_true", default=False)
+
     (options, args) = parser.parse_args()
 
     selection_fields_sql = {}
 
+    # The ? placeholder style only works on the pyodbc engine; the SQLAlchemy fallback
+    # connection gets the values inlined as literal SQL instead
+    use_query_parameters = engine == "pyodbc"
+
     if options.taxonomy_selection_fields:
         taxonomy_selection_field_list = string_list_to_python_list(options.taxonomy_selection_fields)
         taxonomy_selection_field_list_sql = field_selection_with_like("flattened_taxonomy_string",
                                                                       taxonomy_selection_field_list,
                                                                       padding_left_side=True,
                                                                       wild_card_right_side=True,
-                                                                      wild_card_left_side=True, padder="|")
+                                                                      wild_card_left_side=True, padder="|",
+                                                                      parameterized=use_query_parameters)
+        if not use_query_parameters:
+            taxonomy_selection_field_list_sql = (taxonomy_selection_field_list_sql, [])
         selection_fields_sql["taxonomy_field_selection_list"] = taxonomy_selection_field_list_sql
 
     if options.zip_codes:
         zip_code_list = string_list_to_python_list(options.zip_codes)
-        zip_selection_field_list_sql = field_selection_with_like("zip", zip_code_list, padding_left_side=True, wild_card_right_side=True, padder="")
+        zip_selection_field_list_sql = field_selection_with_like("zip", zip_code_list, padding_left_side=True, wild_card_right_side=True, padder="", parameterized=use_query_parameters)
+        if not use_query_parameters:
+            zip_selection_field_list_sql = (zip_selection_field_list_sql, [])
         selection_fields_sql["zip_list"] = zip_selection_field_list_sql
 
     if options.binary_selection_fields:
         binary_selection_field_list = string_list_to_python_list(options.binary_selection_fields)
         binary_selection_field_list_sql = field_selection_with_equal(binary_selection_field_list, 1)
-        selection_fields_sql["binary_selection_list"] = binary_selection_field_list_sql
+        selection_fields_sql["binary_selection_list"] = (binary_selection_field_list_sql, [])
 
     if options.npis:
         npi_list = [int(n) for n in string_list_to_python_list(options.npis)]
-        selection_fields_sql["npi_selection_list"] = "npi in " + str(tuple(npi_list))
+        if use_query_parameters:
+            selection_fields_sql["npi_selection_list"] = ("npi in (%s)" % ",".join(["?"] * len(npi_list)), npi_list)
+        else:
+            selection_fields_sql["npi_selection_list"] = ("npi in (%s)" % ",".join(str(npi) for npi in npi_list), [])
 
     if options.sole_provider:
-        selection_fields_sql["sole_provider"] = "sole_provider = 'Y'"
+        selection_fields_sql["sole_provider"] = ("sole_provider = 'Y'", [])
 
     if options.non_sole_provider:
-        selection_fields_sql["non_sole_provider"] = "sole_provider = 'N'"
+        selection_fields_sql["non_sole_provider"] = ("sole_provider = 'N'", [])
 
     if options.blank_sole_provider:
-        selection_fields_sql["blank_sole_provider"] = "sole_provider is NULL"
+        selection_fields_sql["blank_sole_provider"] = ("sole_provider is NULL", [])
 
     where_criteria = ""
+    where_parameters = []
     for sql_clause in selection_fields_sql:
-        where_criteria += selection_fields_sql[sql_clause] + " and "
+        clause_sql, clause_parameters = selection_fields_sql[sql_clause]
+        where_criteria += clause_sql + " and "
+        where_parameters += clause_parameters
 
     where_criteria = "(" + where_criteria[:-5] + ")"
     print(where_criteria)
@@ -126,4 +154,6 @@ if __name__ == "__main__":
     extract_provider_network(where_criteria, referral_table_name=REFERRAL_TABLE_NAME, npi_detail_table_name=NPI_DETAIL_TABLE_NAME,
          field_name_to_relationship=FIELD_NAME_TO_RELATIONSHIP, field_name_from_relationship=FIELD_NAME_FROM_RELATIONSHIP,
          file_name_prefix=options.base_file_name, add_leaf_to_leaf_edges=options.include_leaf_edges, node_label_name="provider_name",
-         field_name_weight=FIELD_NAME_WEIGHT, add_leaf_nodes=add_leaf_nodes, directory=options.write_directory)
+         field_name_weight=FIELD_NAME_WEIGHT, add_leaf_nodes=add_leaf_nodes, directory=options.write_directory,
+         graphml_output=not options.csv_only, where_parameters=where_parameters,
+         stream_graphml=options.stream_graphml)